@@ -1,9 +1,21 @@
 import streamlit as st
-import geopandas as gpd
-import pandas as pd
 import pydeck as pdk
 from pathlib import Path
 
+from retail_app.core import (
+    COARSE_STEP,
+    RENDER_CAP,
+    cached_coordinates,
+    cached_fill_colors,
+    class_partitions,
+    coarse_view,
+    filter_options,
+    filtered_csv,
+    load_grid_data,
+    preview_rows,
+    summarize,
+)
+
 # =========================================================
 # PAGE CONFIG (HARUS PALING ATAS)
 # =========================================================
@@ -25,69 +37,14 @@ st.markdown(
     "(https://drive.google.com/file/d/1sa14j-L3tioraYqTcS8n1wPE6pwv9D_A/view?usp=sharing)"
 )
 
-# =========================================================
-# LOAD DATA (OPTIMIZED & DEPLOY-SAFE)
-# =========================================================
-@st.cache_data
-def load_grid_data(file_path, simplify_tol):
-    gdf = gpd.read_file(file_path)
-
-    if gdf.crs != "EPSG:4326":
-        gdf = gdf.to_crs("EPSG:4326")
-
-    # Simplify geometry (IMPORTANT for performance)
-    gdf["geometry"] = gdf.geometry.simplify(
-        tolerance=simplify_tol,
-        preserve_topology=True
-    )
-
-    # Representative point (faster than centroid)
-    rp = gdf.geometry.representative_point()
-    gdf["lon"] = rp.x
-    gdf["lat"] = rp.y
-
-    # Precompute polygon coordinates ONCE
-    gdf["coordinates"] = gdf.geometry.apply(
-        lambda geom: [[[x, y] for x, y in geom.exterior.coords]]
-    )
-
-    return gdf
-
-
-# =========================================================
-# COLOR FUNCTIONS
-# =========================================================
-def get_retail_color(retail_class):
-    return {
-        "High": [220, 38, 38, 160],
-        "Medium": [245, 158, 11, 160],
-        "Low": [16, 185, 129, 160],
-    }.get(retail_class, [160, 160, 160, 120])
-
-
-def get_color_scale(value, vmin, vmax):
-    if pd.isna(value):
-        return [200, 200, 200, 80]
-
-    norm = (value - vmin) / (vmax - vmin) if vmax > vmin else 0.5
-    norm = max(0, min(1, norm))
-
-    if norm < 0.5:
-        r, g = 255, int(norm * 2 * 255)
-    else:
-        r, g = int(255 - (norm - 0.5) * 2 * 255), 255
-
-    return [r, g, 0, int(120 + norm * 100)]
-
-
 # =========================================================
 # SIDEBAR
 # =========================================================
 st.sidebar.title("⚙️ Settings")
 
 data_files = {
-    "OKU": "data/grid_retail_expansion_score_oku.gpkg",
-    "Tangsel": "data/grid_retail_expansion_score_tangsel.gpkg"
+    "OKU": "data/grid_retail_expansion_score_oku.parquet",
+    "Tangsel": "data/grid_retail_expansion_score_tangsel.parquet"
 }
 
 selected_dataset = st.sidebar.selectbox(
@@ -102,6 +59,13 @@ full_detail = st.sidebar.checkbox(
 
 simplify_tol = 0.0001 if full_detail else 0.0003
 
+# Picking forces deck.gl to redraw into a pick buffer every frame, so
+# keep it off unless the user actually wants to inspect cells
+enable_tooltip = st.sidebar.checkbox(
+    "Enable tooltips (slower)",
+    value=False
+)
+
 uploaded_file = st.sidebar.file_uploader(
     "Or upload your own file",
     type=["gpkg", "geojson", "shp"]
@@ -111,16 +75,20 @@ if uploaded_file:
     temp = Path("temp_upload.gpkg")
     with open(temp, "wb") as f:
         f.write(uploaded_file.getbuffer())
-    gdf = load_grid_data(temp, simplify_tol)
+    source_path = temp
     dataset_name = uploaded_file.name
 else:
-    gdf = load_grid_data(data_files[selected_dataset], simplify_tol)
+    source_path = data_files[selected_dataset]
     dataset_name = selected_dataset
 
+# Filter widgets run BEFORE the data load so the selections can be
+# pushed down into the read; options come from a geometry-free read
+options = filter_options(source_path)
+
 # Detect landuse column
-if "Keterangan" in gdf.columns:
+if "Keterangan" in options:
     landuse_col = "Keterangan"
-elif "KELAS_2" in gdf.columns:
+elif "KELAS_2" in options:
     landuse_col = "KELAS_2"
 else:
     landuse_col = None
@@ -130,9 +98,11 @@ else:
 # =========================================================
 st.sidebar.subheader("🔍 Filters")
 
+selected_rc = selected_fc = selected_lu = "All"
+
 # Retail Class
-if "retail_class" in gdf.columns:
-    rc_options = ["All"] + sorted(gdf["retail_class"].dropna().unique())
+if "retail_class" in options:
+    rc_options = ["All"] + options["retail_class"]
     default_rc = "High" if "High" in rc_options else "All"
 
     selected_rc = st.sidebar.selectbox(
@@ -141,12 +111,9 @@ if "retail_class" in gdf.columns:
         index=rc_options.index(default_rc)
     )
 
-    if selected_rc != "All":
-        gdf = gdf[gdf["retail_class"] == selected_rc]
-
 # Flood Class
-if "flood_class" in gdf.columns:
-    fc_options = ["All"] + sorted(gdf["flood_class"].dropna().unique())
+if "flood_class" in options:
+    fc_options = ["All"] + options["flood_class"]
 
     if "Low" in fc_options:
         default_fc = "Low"
@@ -161,12 +128,9 @@ if "flood_class" in gdf.columns:
         index=fc_options.index(default_fc)
     )
 
-    if selected_fc != "All":
-        gdf = gdf[gdf["flood_class"] == selected_fc]
-
 # Landuse / Keterangan
 if landuse_col:
-    lu_options = ["All"] + sorted(gdf[landuse_col].dropna().unique())
+    lu_options = ["All"] + options[landuse_col]
 
     if "Permukiman" in lu_options:
         default_lu = "Permukiman"
@@ -181,9 +145,79 @@ if landuse_col:
         index=lu_options.index(default_lu)
     )
 
-    if selected_lu != "All":
+# =========================================================
+# LOAD + FILTER DATA
+# =========================================================
+if uploaded_file:
+    # Push the filters down into GDAL so non-matching features are
+    # never materialized
+    active_filters = [
+        (col, sel) for col, sel in (
+            ("retail_class", selected_rc),
+            ("flood_class", selected_fc),
+            (landuse_col, selected_lu),
+        )
+        if col and sel != "All"
+    ]
+    where = " AND ".join(
+        "{} = '{}'".format(col, sel.replace("'", "''"))
+        for col, sel in active_filters
+    ) or None
+    gdf = load_grid_data(source_path, simplify_tol, where=where)
+else:
+    # Shipped datasets are pre-partitioned by (retail_class,
+    # flood_class), so the dropdown switch is a dict lookup
+    partitions = class_partitions(source_path, simplify_tol)
+    gdf = partitions[(selected_rc, selected_fc)]
+    if landuse_col and selected_lu != "All" and landuse_col in gdf.columns:
         gdf = gdf[gdf[landuse_col] == selected_lu]
 
+# =========================================================
+# FOCUS AREA (VIEWPORT CULLING)
+# =========================================================
+# pydeck cannot report the live viewport back to Streamlit, so offer an
+# explicit bounding box instead of shipping every polygon when the user
+# only cares about a small area. Cells are culled by their
+# representative point, which is at worst one cell off at the edges.
+bbox_key = None
+
+with st.sidebar.expander("🔭 Focus Area"):
+    use_bbox = st.checkbox("Limit to bounding box", value=False)
+
+    if use_bbox and len(gdf):
+        lon_min, lon_max = float(gdf["lon"].min()), float(gdf["lon"].max())
+        lat_min, lat_max = float(gdf["lat"].min()), float(gdf["lat"].max())
+
+        # A narrow selection can collapse to a single row or column of
+        # cells; st.slider requires min < max, so pad degenerate axes
+        # by half a coarse block
+        pad = COARSE_STEP / 2
+        if lon_min == lon_max:
+            lon_min, lon_max = lon_min - pad, lon_max + pad
+        if lat_min == lat_max:
+            lat_min, lat_max = lat_min - pad, lat_max + pad
+
+        lon_range = st.slider(
+            "Longitude", lon_min, lon_max, (lon_min, lon_max)
+        )
+        lat_range = st.slider(
+            "Latitude", lat_min, lat_max, (lat_min, lat_max)
+        )
+
+        lon = gdf["lon"].to_numpy()
+        lat = gdf["lat"].to_numpy()
+        gdf = gdf[
+            (lon >= lon_range[0]) & (lon <= lon_range[1])
+            & (lat >= lat_range[0]) & (lat <= lat_range[1])
+        ]
+        bbox_key = lon_range + lat_range
+
+# Everything that determines the visible rows; keys the render caches
+filter_key = (
+    str(source_path), dataset_name, simplify_tol,
+    selected_rc, selected_fc, selected_lu, bbox_key,
+)
+
 # =========================================================
 # MAIN
 # =========================================================
@@ -196,18 +230,21 @@ st.markdown("---")
 # =========================================================
 # METRICS
 # =========================================================
+# All metric aggregates come from one cached pass over the rows
+summary = summarize(filter_key, gdf)
+
 col1, col2, col3, col4 = st.columns(4)
 
-col1.metric("Total Grids", f"{len(gdf):,}")
+col1.metric("Total Grids", f"{summary['n']:,}")
 
-if "retail_class" in gdf.columns:
-    col2.metric("Retail High", f"{(gdf['retail_class']=='High').sum():,}")
+if "high" in summary:
+    col2.metric("Retail High", f"{summary['high']:,}")
 
-if "pop_dasymetric" in gdf.columns:
-    col3.metric("Total Population", f"{gdf['pop_dasymetric'].sum():,.0f}")
+if "pop" in summary:
+    col3.metric("Total Population", f"{summary['pop']:,.0f}")
 
-if "access_idx" in gdf.columns:
-    col4.metric("Grid with Access", f"{(gdf['access_idx']==1).sum():,}")
+if "access" in summary:
+    col4.metric("Grid with Access", f"{summary['access']:,}")
 
 st.markdown("---")
 
@@ -222,42 +259,60 @@ viz_mode = st.radio(
     horizontal=True
 )
 
-gdf_plot = gdf.copy()
-
-# Coloring
-if viz_mode == "Retail Class" and "retail_class" in gdf_plot.columns:
-    gdf_plot["fill_color"] = gdf_plot["retail_class"].apply(get_retail_color)
-else:
-    vmin, vmax = gdf_plot["retail_score"].min(), gdf_plot["retail_score"].max()
-    gdf_plot["fill_color"] = gdf_plot["retail_score"].apply(
-        lambda x: get_color_scale(x, vmin, vmax)
+if len(gdf) > RENDER_CAP:
+    # Too many cells for per-polygon rendering: ship aggregated blocks
+    # (colored by mean score) until the selection narrows
+    gdf_plot = coarse_view(filter_key, gdf)
+    tooltip_html = gdf_plot.attrs["tooltip_html"]
+    st.caption(
+        f"{len(gdf):,} cells aggregated into {len(gdf_plot):,} blocks — "
+        "narrow the filters or focus area for full resolution"
     )
-
-# Tooltip (FULL INFO)
-tooltip_html = "<b>Grid ID:</b> {gid}<br/>"
-tooltip_cols = [
-    "retail_class", "retail_score", landuse_col,
-    "pop_dasymetric", "flood_class",
-    "demand_idx", "flood_risk_idx", "access_idx"
-]
-tooltip_cols = [c for c in tooltip_cols if c and c in gdf_plot.columns]
-
-for c in tooltip_cols:
-    tooltip_html += f"<b>{c}:</b> {{{c}}}<br/>"
+else:
+    # Slim plotting frame: shares the attribute columns with gdf under
+    # copy-on-write (no deep copy of the filtered frame) and carries
+    # only what the layer and tooltip need — notably no geometry column
+    plot_cols = [
+        c for c in (
+            "gid", "retail_class", "retail_score", "score_bin",
+            landuse_col, "pop_dasymetric", "flood_class", "demand_idx",
+            "flood_risk_idx", "access_idx",
+        )
+        if c and c in gdf.columns
+    ]
+    gdf_plot = gdf[plot_cols]
+
+    # Ring lists and colors are memoized on the filter state, so mode
+    # toggles and unrelated widget interactions reuse them
+    gdf_plot["coordinates"] = cached_coordinates(filter_key, gdf)
+    gdf_plot["fill_color"] = cached_fill_colors(filter_key, viz_mode, gdf)
+
+    # Tooltip (FULL INFO, built once per dataset at load)
+    tooltip_html = gdf.attrs["tooltip_html"]
+
+# Stroke rendering causes heavy overdraw at low zoom, so above 10k
+# polygons drop it and use the plain fill layer instead of the
+# composite PolygonLayer (half the deck.gl sub-layers)
+stroked = len(gdf_plot) < 10_000
 
 layer = pdk.Layer(
-    "PolygonLayer",
+    "PolygonLayer" if stroked else "SolidPolygonLayer",
     data=gdf_plot,
     get_polygon="coordinates",
     get_fill_color="fill_color",
-    stroked=True,
+    stroked=stroked,
     filled=True,
-    pickable=True
+    pickable=enable_tooltip,
+    auto_highlight=enable_tooltip
 )
 
+# Dataset center is cached at load; keeping it independent of the
+# active filters also stops the map jumping around on filter changes
+center_lat, center_lon = gdf.attrs["center"]
+
 view = pdk.ViewState(
-    latitude=gdf_plot["lat"].mean(),
-    longitude=gdf_plot["lon"].mean(),
+    latitude=center_lat,
+    longitude=center_lon,
     zoom=10
 )
 
@@ -265,11 +320,24 @@ deck = pdk.Deck(
     layers=[layer],
     initial_view_state=view,
     map_style="https://basemaps.cartocdn.com/gl/positron-gl-style/style.json",  # ← OpenStreetMap default (NO TOKEN)
-    tooltip={"html": tooltip_html}
+    tooltip={"html": tooltip_html} if enable_tooltip else False
 )
 
 st.pydeck_chart(deck, use_container_width=True)
 
+# =========================================================
+# DATA PREVIEW + DOWNLOAD
+# =========================================================
+with st.expander("📋 Data Preview (first 1,000 rows)"):
+    st.dataframe(preview_rows(filter_key, gdf), use_container_width=True)
+
+st.download_button(
+    "⬇️ Download filtered data (CSV)",
+    data=filtered_csv(filter_key, gdf),
+    file_name=f"retail_expansion_{dataset_name}.csv".replace(" ", "_"),
+    mime="text/csv",
+)
+
 # =========================================================
 # FOOTER
 # =========================================================
@@ -0,0 +1,451 @@
+"""Shared data pipeline and styling for the retail expansion dashboard.
+
+Everything here is importable without a running Streamlit session, so
+scripts/prebake.py reuses the exact pipeline the app runs for uploads.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+import streamlit as st
+
+# Columns the dashboard actually uses; everything else is dropped at
+# load time to shrink the working set
+USED_COLUMNS = {
+    "gid", "retail_class", "retail_score", "pop_dasymetric",
+    "flood_class", "demand_idx", "flood_risk_idx", "access_idx",
+    "Keterangan", "KELAS_2", "geometry",
+}
+
+CACHE_DIR = Path("data/cache")
+
+# Below this row count the thread-pool overhead isn't worth it
+PARALLEL_MIN_ROWS = 20_000
+
+TOOLTIP_COLUMNS = (
+    "retail_class", "retail_score", "Keterangan", "KELAS_2",
+    "pop_dasymetric", "flood_class",
+    "demand_idx", "flood_risk_idx", "access_idx",
+)
+
+FILTER_COLUMNS = ("retail_class", "flood_class", "Keterangan", "KELAS_2")
+
+# Rows follow the retail_class category order (High, Medium, Low,
+# Very High); the last row also colors missing / unknown classes
+RETAIL_PALETTE = np.array(
+    [
+        [220, 38, 38, 160],
+        [245, 158, 11, 160],
+        [16, 185, 129, 160],
+        [160, 160, 160, 120],
+    ],
+    dtype=np.uint8,
+)
+
+
+def parallel_geom(func, geoms):
+    """Apply a shapely ufunc over row chunks in parallel.
+
+    GEOS releases the GIL in shapely 2.x, so threads scale across cores
+    for large uploads; small arrays just run serially.
+    """
+    if len(geoms) < PARALLEL_MIN_ROWS:
+        return func(geoms)
+    chunks = np.array_split(geoms, os.cpu_count() or 1)
+    with ThreadPoolExecutor() as pool:
+        return np.concatenate(list(pool.map(func, chunks)))
+
+
+def build_tooltip(columns):
+    """Tooltip HTML for the columns present, built once per dataset."""
+    return "<b>Grid ID:</b> {gid}<br/>" + "".join(
+        f"<b>{c}:</b> {{{c}}}<br/>" for c in TOOLTIP_COLUMNS if c in columns
+    )
+
+
+def retail_class_colors(series):
+    """(N, 4) uint8 colors for a categorical retail_class column.
+
+    One fancy-index into RETAIL_PALETTE; unknown / missing classes get
+    the fallback row.
+    """
+    codes = series.cat.codes.to_numpy()
+    return RETAIL_PALETTE[np.where(codes < 0, 3, codes)]
+
+
+def build_colors(scores, vmin, vmax):
+    """Vectorized red->yellow->green ramp returning an (N, 4) uint8 array."""
+    scores = np.asarray(scores, dtype=np.float64)
+    nan_mask = np.isnan(scores)
+
+    if vmax > vmin:
+        norm = np.clip((scores - vmin) / (vmax - vmin), 0, 1)
+    else:
+        norm = np.full(len(scores), 0.5)
+    norm = np.where(nan_mask, 0.5, norm)
+
+    rgba = np.empty((len(scores), 4), dtype=np.uint8)
+    rgba[:, 0] = np.where(norm < 0.5, 255, 255 - (norm - 0.5) * 2 * 255)
+    rgba[:, 1] = np.where(norm < 0.5, norm * 2 * 255, 255)
+    rgba[:, 2] = 0
+    rgba[:, 3] = 120 + norm * 100
+    rgba[nan_mask] = [200, 200, 200, 80]
+
+    return rgba
+
+
+# Colors for the eight retail_score quantile bins, sampled from the
+# same ramp; the extra last row colors missing scores
+SCORE_PALETTE = np.vstack([
+    build_colors(np.linspace(0.0, 1.0, 8), 0.0, 1.0),
+    [[200, 200, 200, 80]],
+]).astype(np.uint8)
+
+
+def process_grid(gdf, simplify_tol):
+    """Run the full geometry/attribute pipeline on a raw GeoDataFrame.
+
+    Normalizes CRS and dtypes, bins the score, simplifies, computes
+    representative points, and packs the ring buffers onto .attrs.
+    """
+    gdf = gdf[[c for c in gdf.columns if c in USED_COLUMNS]]
+
+    if gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
+
+    # Fixed categories let color mapping use integer codes instead of
+    # per-row string dispatch; category order matches RETAIL_PALETTE
+    if "retail_class" in gdf.columns:
+        gdf["retail_class"] = pd.Categorical(
+            gdf["retail_class"],
+            categories=["High", "Medium", "Low", "Very High"],
+        )
+
+    # Downcast the attribute columns: float32 and uint8 halve the RAM
+    # held per session and the payload serialized to the browser
+    for c in gdf.select_dtypes("float64").columns:
+        gdf[c] = gdf[c].astype("float32")
+    if "access_idx" in gdf.columns:
+        gdf["access_idx"] = gdf["access_idx"].astype("uint8")
+    for c in ("flood_class", "Keterangan", "KELAS_2"):
+        if c in gdf.columns:
+            gdf[c] = gdf[c].astype("category")
+
+    # Pre-binned retail score: render-time coloring becomes a palette
+    # lookup instead of per-rerender float math
+    if "retail_score" in gdf.columns:
+        gdf["score_bin"] = pd.qcut(
+            gdf["retail_score"], q=8, labels=False, duplicates="drop"
+        ).astype("Int8")
+
+    # Simplify geometry (IMPORTANT for performance), in parallel row
+    # chunks when the upload is large
+    geoms = parallel_geom(
+        lambda g: shapely.simplify(g, simplify_tol, preserve_topology=True),
+        gdf.geometry.values,
+    )
+    gdf["geometry"] = gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs)
+
+    # Representative point (faster than centroid) via the shapely 2.x
+    # ufunc: one C loop over the array, no intermediate GeoSeries
+    rp = shapely.get_coordinates(
+        parallel_geom(shapely.point_on_surface, geoms)
+    )
+    gdf["lon"] = rp[:, 0]
+    gdf["lat"] = rp[:, 1]
+
+    # Pack polygon rings ONCE into flat binary buffers (positions +
+    # per-polygon start offsets) instead of a column of nested Python
+    # lists — far smaller in memory and cheap to slice per row later
+    coords, index = shapely.get_coordinates(geoms, return_index=True)
+    ring_starts = np.zeros(len(gdf) + 1, dtype=np.uint32)
+    ring_starts[1:] = np.bincount(index, minlength=len(gdf)).cumsum()
+
+    # The flat buffer interleaves rings for MultiPolygons / polygons
+    # with holes, so keep prebuilt nested lists for those rows only
+    irregular = (gdf.geom_type.to_numpy() != "Polygon") | (
+        shapely.get_num_interior_rings(geoms) > 0
+    )
+    irregular_rings = {}
+    for i in np.flatnonzero(irregular):
+        geom = geoms[i]
+        parts = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+        irregular_rings[i] = [
+            np.asarray(p.exterior.coords).tolist() for p in parts
+        ]
+
+    gdf.attrs["positions"] = coords
+    gdf.attrs["ring_starts"] = ring_starts
+    gdf.attrs["irregular_rings"] = irregular_rings
+    gdf.attrs["center"] = (float(rp[:, 1].mean()), float(rp[:, 0].mean()))
+    gdf.attrs["tooltip_html"] = build_tooltip(gdf.columns)
+    if "retail_score" in gdf.columns:
+        gdf.attrs["score_range"] = (
+            float(gdf["retail_score"].min()),
+            float(gdf["retail_score"].max()),
+        )
+
+    return gdf
+
+
+# cache_resource instead of cache_data: the frame (plus the buffers on
+# .attrs) is treated as read-only downstream — filters and the plot
+# frame all derive new objects — so skip cache_data's per-retrieval
+# deep copy, which is expensive for the geometry buffers
+@st.cache_resource
+def load_grid_data(file_path, simplify_tol, where=None):
+    # Prebaked bundles (see scripts/prebake.py) skip the whole geometry
+    # pipeline on cold start; uploads fall through to the full path
+    stem = f"{Path(file_path).stem}_{simplify_tol:g}"
+    npz_path = CACHE_DIR / f"{stem}.npz"
+    attrs_path = CACHE_DIR / f"{stem}.parquet"
+    if where is None and npz_path.exists() and attrs_path.exists():
+        arrays = np.load(npz_path)
+        df = pd.read_parquet(attrs_path)
+        df["lon"] = arrays["lon"]
+        df["lat"] = arrays["lat"]
+        df.attrs["positions"] = arrays["positions"]
+        df.attrs["ring_starts"] = arrays["ring_starts"]
+        df.attrs["irregular_rings"] = {}
+        df.attrs["center"] = (
+            float(arrays["lat"].mean()), float(arrays["lon"].mean())
+        )
+        df.attrs["tooltip_html"] = build_tooltip(df.columns)
+        if "retail_score" in df.columns:
+            df.attrs["score_range"] = (
+                float(df["retail_score"].min()),
+                float(df["retail_score"].max()),
+            )
+        return df
+
+    # GeoParquet (see scripts/convert_to_parquet.py) loads columnar
+    # buffers directly; other formats go through pyogrio + arrow. In
+    # both cases push the column selection into the read so unused
+    # attribute columns are never deserialized (process_grid's prune
+    # stays as a safety net for columns the source lacks metadata for)
+    if str(file_path).endswith(".parquet"):
+        names = pq.read_schema(file_path).names
+        gdf = gpd.read_parquet(
+            file_path, columns=[c for c in names if c in USED_COLUMNS]
+        )
+    else:
+        # `where` lets GDAL skip non-matching features at read time, so
+        # rows the filters would discard are never materialized; the
+        # geometry column rides along implicitly
+        fields = pyogrio.read_info(str(file_path))["fields"]
+        gdf = gpd.read_file(
+            file_path,
+            engine="pyogrio",
+            use_arrow=True,
+            where=where,
+            columns=[c for c in fields if c in USED_COLUMNS],
+        )
+
+    return process_grid(gdf, simplify_tol)
+
+
+@st.cache_resource
+def class_partitions(file_path, simplify_tol):
+    """Pre-partition a dataset by (retail_class, flood_class).
+
+    Dropdown switches then resolve to a dict lookup instead of a
+    full-column scan plus copy on every interaction. Rows with a class
+    outside the listed values only appear under "All".
+    """
+    gdf = load_grid_data(file_path, simplify_tol)
+
+    rc_col = gdf["retail_class"] if "retail_class" in gdf.columns else None
+    fc_col = gdf["flood_class"] if "flood_class" in gdf.columns else None
+    rc_keys = ["All"] + (
+        sorted(rc_col.dropna().unique()) if rc_col is not None else []
+    )
+    fc_keys = ["All"] + (
+        sorted(fc_col.dropna().unique()) if fc_col is not None else []
+    )
+
+    parts = {}
+    for rc in rc_keys:
+        rc_mask = None if rc == "All" else (rc_col == rc).to_numpy()
+        for fc in fc_keys:
+            mask = rc_mask
+            if fc != "All":
+                fc_mask = (fc_col == fc).to_numpy()
+                mask = fc_mask if mask is None else mask & fc_mask
+            parts[(rc, fc)] = gdf if mask is None else gdf[mask]
+    return parts
+
+
+def polygon_coordinates(gdf_subset):
+    """Build deck.gl ring lists for the given rows from the flat buffers."""
+    positions = gdf_subset.attrs["positions"]
+    starts = gdf_subset.attrs["ring_starts"].astype(np.int64)
+    irregular = gdf_subset.attrs["irregular_rings"]
+    rows = gdf_subset.index.to_numpy()
+
+    # Grid cells share one vertex count (5 for rectangles), so the
+    # common case gathers every ring with a single fancy-index and one
+    # tolist call instead of a per-row slice loop
+    if not irregular and len(rows):
+        counts = starts[rows + 1] - starts[rows]
+        k = counts[0]
+        if (counts == k).all():
+            block = positions[starts[rows, None] + np.arange(k)]
+            return [[ring] for ring in block.tolist()]
+
+    return [
+        irregular[i] if i in irregular
+        else [positions[starts[i]:starts[i + 1]].tolist()]
+        for i in rows
+    ]
+
+
+# cache_resource, not cache_data: the returned nested lists are big,
+# read-only, and go straight into the layer, so the per-retrieval deep
+# copy cache_data would do is pure waste. The leading-underscore
+# argument is excluded from the cache key; `cache_key` must capture
+# everything that determines the visible rows.
+@st.cache_resource
+def cached_coordinates(cache_key, _gdf):
+    """polygon_coordinates memoized on the active filter state."""
+    return polygon_coordinates(_gdf)
+
+
+@st.cache_resource
+def cached_fill_colors(cache_key, viz_mode, _gdf):
+    """Row colors memoized on (filter state, visualization mode)."""
+    if viz_mode == "Retail Class" and "retail_class" in _gdf.columns:
+        return retail_class_colors(_gdf["retail_class"]).tolist()
+    bins = _gdf["score_bin"].to_numpy(dtype="int64", na_value=8)
+    return SCORE_PALETTE[bins].tolist()
+
+
+# Above this many visible cells the map switches to aggregated blocks
+RENDER_CAP = 25_000
+
+# Aggregation block size in degrees (~1.1 km)
+COARSE_STEP = 0.01
+
+
+@st.cache_resource
+def coarse_view(cache_key, _gdf):
+    """Aggregate the visible cells into COARSE_STEP-sized blocks.
+
+    Rendering the full dataset cell by cell is payload- and GPU-bound;
+    above RENDER_CAP the map shows these blocks (mean score, summed
+    population) until filters or the focus area narrow the selection.
+    """
+    half = COARSE_STEP / 2
+
+    df = pd.DataFrame({
+        "block_lat": np.round(_gdf["lat"].to_numpy() / COARSE_STEP)
+        * COARSE_STEP,
+        "block_lon": np.round(_gdf["lon"].to_numpy() / COARSE_STEP)
+        * COARSE_STEP,
+    })
+    spec = {"n_cells": ("block_lat", "size")}
+    if "retail_score" in _gdf.columns:
+        df["retail_score"] = _gdf["retail_score"].to_numpy()
+        spec["retail_score"] = ("retail_score", "mean")
+    if "pop_dasymetric" in _gdf.columns:
+        df["pop_dasymetric"] = _gdf["pop_dasymetric"].to_numpy()
+        spec["pop_dasymetric"] = ("pop_dasymetric", "sum")
+
+    blocks = df.groupby(
+        ["block_lat", "block_lon"], as_index=False
+    ).agg(**spec)
+
+    lon = blocks["block_lon"].to_numpy()
+    lat = blocks["block_lat"].to_numpy()
+    ring = np.empty((len(blocks), 5, 2))
+    ring[:, 0, 0] = ring[:, 3, 0] = ring[:, 4, 0] = lon - half
+    ring[:, 1, 0] = ring[:, 2, 0] = lon + half
+    ring[:, 0, 1] = ring[:, 1, 1] = ring[:, 4, 1] = lat - half
+    ring[:, 2, 1] = ring[:, 3, 1] = lat + half
+    blocks["coordinates"] = [[r] for r in ring.tolist()]
+
+    if "retail_score" in blocks.columns:
+        vmin, vmax = _gdf.attrs.get("score_range", (0.0, 1.0))
+        blocks["retail_score"] = blocks["retail_score"].round(3)
+        blocks["fill_color"] = build_colors(
+            blocks["retail_score"].to_numpy(), vmin, vmax
+        ).tolist()
+    else:
+        blocks["fill_color"] = [[160, 160, 160, 120]] * len(blocks)
+
+    blocks.attrs["tooltip_html"] = "<b>Cells:</b> {n_cells}<br/>" + "".join(
+        f"<b>{c}:</b> {{{c}}}<br/>"
+        for c in ("retail_score", "pop_dasymetric")
+        if c in blocks.columns
+    )
+    return blocks
+
+
+@st.cache_data
+def summarize(cache_key, _gdf):
+    """Metric-row aggregates, fused into one pass over the filtered rows."""
+    summary = {"n": len(_gdf)}
+    if "retail_class" in _gdf.columns:
+        summary["high"] = int((_gdf["retail_class"] == "High").sum())
+    if "pop_dasymetric" in _gdf.columns:
+        summary["pop"] = float(_gdf["pop_dasymetric"].sum())
+    if "access_idx" in _gdf.columns:
+        summary["access"] = int((_gdf["access_idx"] == 1).sum())
+    return summary
+
+
+@st.cache_data
+def preview_rows(cache_key, _gdf, n=1000):
+    """First n filtered rows for the preview table, sliced once per
+    filter state instead of on every rerun."""
+    out = _gdf.head(n).reset_index(drop=True)
+    # head() propagates .attrs, which carries the geometry buffers;
+    # don't pickle those into every cache entry (and st.dataframe
+    # can't serialize them anyway)
+    out.attrs = {}
+    return out
+
+
+@st.cache_data
+def filtered_csv(cache_key, _gdf):
+    """CSV bytes of the filtered rows, rebuilt only when filters change.
+
+    Streamlit reruns the whole script per interaction, so without the
+    cache the full CSV string would be materialized every time even if
+    the download button is never clicked.
+    """
+    return _gdf.to_csv(index=False, float_format="%.4f").encode("utf-8")
+
+
+@st.cache_data
+def filter_options(file_path):
+    """Distinct values per filter column, read without geometry."""
+    path = str(file_path)
+
+    # The attribute half of any prebaked bundle has the same class
+    # values as the dataset, is a fraction of its size, and stores the
+    # columns dictionary-encoded — prefer it when one exists
+    baked = sorted(CACHE_DIR.glob(f"{Path(path).stem}_*.parquet"))
+    if baked:
+        path = str(baked[0])
+
+    if path.endswith(".parquet"):
+        present = [
+            c for c in FILTER_COLUMNS if c in pq.read_schema(path).names
+        ]
+        df = pd.read_parquet(path, columns=present)
+    else:
+        present = [
+            c for c in FILTER_COLUMNS
+            if c in pyogrio.read_info(path)["fields"]
+        ]
+        df = pyogrio.read_dataframe(
+            path, columns=present, read_geometry=False
+        )
+    return {c: sorted(df[c].dropna().unique()) for c in present}
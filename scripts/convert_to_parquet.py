@@ -0,0 +1,19 @@
+"""One-time conversion of the shipped GPKG grids to GeoParquet.
+
+GeoParquet reads columnar buffers straight into pandas
+(gpd.read_parquet) instead of GDAL's per-feature iteration, which makes
+the dashboard cold start much faster. Run from the repository root:
+
+    python scripts/convert_to_parquet.py
+"""
+
+from pathlib import Path
+
+import geopandas as gpd
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+
+for gpkg in sorted(DATA_DIR.glob("grid_retail_expansion_score_*.gpkg")):
+    out = gpkg.with_suffix(".parquet")
+    print(f"{gpkg.name} -> {out.name}")
+    gpd.read_file(gpkg).to_parquet(out)
@@ -0,0 +1,60 @@
+"""Pre-bake the processed grid bundles the dashboard loads at startup.
+
+A cold start otherwise re-runs read -> to_crs -> simplify ->
+representative_point -> ring packing for the selected dataset. The
+dashboard only ever combines the two shipped datasets with the two
+sidebar tolerances (full detail on/off), so bake all four variants into
+data/cache/ and let retail_app.core.load_grid_data just load them. Each
+variant is an .npz (positions, ring_starts, lon, lat) plus a .parquet
+of the attribute columns. Run from the repository root after
+scripts/convert_to_parquet.py:
+
+    python scripts/prebake.py
+"""
+
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from retail_app.core import process_grid  # noqa: E402
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+CACHE_DIR = DATA_DIR / "cache"
+
+TOLERANCES = (0.0001, 0.0003)
+
+
+def bake(parquet_path, simplify_tol):
+    """Run the app's pipeline once and write the bundle."""
+    gdf = process_grid(gpd.read_parquet(parquet_path), simplify_tol)
+
+    if gdf.attrs["irregular_rings"]:
+        # The baked format assumes one exterior ring per row; leave this
+        # variant to the app's full fallback path
+        print(f"  skipping ({len(gdf.attrs['irregular_rings'])} non-simple polygons)")
+        return
+
+    stem = f"{parquet_path.stem}_{simplify_tol:g}"
+    np.savez(
+        CACHE_DIR / f"{stem}.npz",
+        positions=gdf.attrs["positions"],
+        ring_starts=gdf.attrs["ring_starts"],
+        lon=gdf["lon"].to_numpy(),
+        lat=gdf["lat"].to_numpy(),
+    )
+    attrs_df = gdf.drop(columns=["geometry", "lon", "lat"])
+    # The buffers live in the .npz; keep them out of parquet metadata
+    attrs_df.attrs = {}
+    attrs_df.to_parquet(CACHE_DIR / f"{stem}.parquet")
+
+
+if __name__ == "__main__":
+    CACHE_DIR.mkdir(exist_ok=True)
+    for parquet_path in sorted(DATA_DIR.glob("grid_retail_expansion_score_*.parquet")):
+        for tol in TOLERANCES:
+            print(f"{parquet_path.name} @ {tol:g}")
+            bake(parquet_path, tol)